@@ -1,11 +1,19 @@
+import concurrent.futures
 import logging
 import os
-import glob
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import types
 from typing import Annotated, Optional
 
+import numpy as np
 import vtk
 import qt
 import ctk
+from vtk.util.numpy_support import vtk_to_numpy
 
 
 import slicer
@@ -18,15 +26,38 @@ from slicer.parameterNodeWrapper import (
     WithinRange,
 )
 
-import ScreenCapture
-
 from slicer import vtkMRMLScalarVolumeNode
 
 try:
-    from moviepy.editor import ImageSequenceClip
+    import nibabel as nib
 except:
-    slicer.util.pip_install('moviepy')
-    from moviepy.editor import ImageSequenceClip
+    slicer.util.pip_install('nibabel')
+    import nibabel as nib
+
+# numba is optional and imported on the first threshold, without it the threshold runs slab by slab in numpy
+_NUMBA_KERNELS = None
+
+def _load_numba():
+    """Compile the threshold kernel on first use. Returns None when numba is not installed."""
+    global _NUMBA_KERNELS
+
+    if _NUMBA_KERNELS is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _NUMBA_KERNELS = False
+            return None
+
+        @njit(parallel=True, cache=True)
+        def thresholdBelow(voxels, thresholdValue):
+            flat = voxels.reshape(voxels.size)
+            for index in prange(flat.size):
+                if flat[index] < thresholdValue:
+                    flat[index] = 0
+
+        _NUMBA_KERNELS = types.SimpleNamespace(thresholdBelow=thresholdBelow)
+
+    return _NUMBA_KERNELS or None
 
 
 #
@@ -106,6 +137,16 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.current_file = 0
         self.total_files = 0
 
+        # image folder and its modification time of the last Load
+        self._lastFilesetKey = None
+
+        # nodes added to the scene for the current file, removed again before the next file is loaded
+        self._createdNodes = []
+
+        # file index -> future of (voxels, affine) decompressed by the background worker
+        self._prefetchCache = {}
+        self._prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
     def setup(self) -> None:
 
         def createHLayout(elements):
@@ -167,6 +208,16 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         MainFormLayout.addRow("file list : ",createHLayout([self.FileComboBox]))
         MainFormLayout.addRow(createHLayout([self.CreateVideoButton]))
 
+        self.logic = ImplantVideoLogic()
+
+        # layout manager and layout logic are application singletons
+        self.layoutManager = slicer.app.layoutManager()
+        self.layoutLogic = self.layoutManager.layoutLogic()
+
+        # volume rendering preset is the same for every file, look it up only once
+        self.volRenLogic = slicer.modules.volumerendering.logic()
+        self.ctAAAPreset = self.volRenLogic.GetPresetByName("CT-AAA")
+
         # Connections
 
         # These connections ensure that we update parameter node when scene is closed
@@ -183,11 +234,25 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onRun(self):
 
+        if self.imageDirectory == "":
+
+            slicer.util.warningDisplay('Please choose image folder', windowTitle='Mangomedcial')
+            return
+
+        # pressing Load again on an unchanged folder keeps the current file list and the loaded file
+        filesetKey = (self.imageDirectory, os.stat(self.imageDirectory).st_mtime_ns)
+
+        if filesetKey == self._lastFilesetKey:
+            return
+
+        self._lastFilesetKey = filesetKey
+
         # check directory
-        self.fileset = sorted(glob.glob(os.path.join(self.imageDirectory, "*.nii.gz")))
+        self.fileset = sorted(entry.path for entry in os.scandir(self.imageDirectory) if entry.name.endswith(".nii.gz") and entry.is_file())
 
         self.total_files = len(self.fileset)
         self.current_file = 0
+        self._prefetchCache.clear()
 
         print('the number of file set : ', self.total_files)
 
@@ -226,12 +291,15 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.total_files = 0
         self.imageDirectory = ""
         self.fileset = []
+        self._lastFilesetKey = None
+        self._prefetchCache.clear()
         self.FileComboBox.clear()
 
         self.DirButton.setText(self.saveDirectory)
 
         slicer.util.resetSliceViews()
         slicer.mrmlScene.Clear(0)
+        self._createdNodes.clear()
 
     def onDir(self):
 
@@ -248,45 +316,34 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             slicer.util.warningDisplay('Please choose destination folder', windowTitle='Mangomedcial')
             return
 
-        # Specify the directory with your images and the output video filename
-        image_basename = os.path.basename(self.fileset[self.current_file])
-        image_name = image_basename[:image_basename.find('.nii.gz')]
+        # Specify the output video filename
+        image_name = os.path.basename(self.fileset[self.current_file]).removesuffix('.nii.gz')
         video_file = os.path.join(self.saveDirectory, image_name + ".mp4")
 
-        # create png images
-        viewNode = slicer.mrmlScene.GetNodeByID("vtkMRMLViewNode1")
-        ScreenCapture.ScreenCaptureLogic().capture3dViewRotation(viewNode, -180, 180, 360, 0, self.saveDirectory, "image_%05d.png")
-
-        # Use glob to find all images that match the pattern
-        images_pattern = os.path.join(self.saveDirectory, 'image_*.png')
-        images_list = sorted(glob.glob(images_pattern))
-
-        # Ensure the images are sorted correctly
-        images_list.sort()
-
-        # Create a video clip from the images
-        clip = ImageSequenceClip(images_list, fps=60)  # Change fps to your desired frame rate
-        clip.write_videofile(video_file)
+        try:
+            self.logic.createRotationVideo(self.layoutManager.threeDWidget(0).threeDView(), video_file)
+        except RuntimeError as error:
+            slicer.util.warningDisplay('Failed to create video.\n{}'.format(error), windowTitle='Mangomedcial')
+            return
 
-        # After successfully creating the video, delete the PNG files
-        for image_path in images_list:
-            os.remove(image_path)
-        
         print(f'created video. {video_file}')
 
-
     def InsertFileCombo(self):
 
-        for index in range(self.total_files):
+        image_names = [os.path.basename(filepath).removesuffix('.nii.gz') for filepath in self.fileset]
 
-            image_basename = os.path.basename(self.fileset[index])
-            image_name = image_basename[:image_basename.find('.nii.gz')]
+        # fill the list without calling onFileCombo for every item, then load the first file once
+        self.FileComboBox.blockSignals(True)
+        self.FileComboBox.clear()
+        self.FileComboBox.addItems(image_names)
+        self.FileComboBox.blockSignals(False)
 
-            self.FileComboBox.addItem(image_name)
+        if self.total_files != 0:
+            self.onFileCombo(0)
 
     def onFileCombo(self, index):
 
-        if self.currentVolumeNode:
+        if self._createdNodes:
             self.RemoveCurrentScene()
 
         if self.total_files != 0:
@@ -309,43 +366,96 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         else:
 
-            # load volume node and segmentation node
-            self.currentVolumeNode = slicer.util.loadVolume(self.fileset[self.current_file])
+            # load volume node, voxels below 2000 are removed to extract the implant
+            self.currentVolumeNode = self.LoadVolume(self.current_file, thresholdValue=2000)
 
             # display volume into 3D view
-            volRenLogic = slicer.modules.volumerendering.logic()
-            displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
-            displayNode.GetVolumePropertyNode().Copy(volRenLogic.GetPresetByName("CT-AAA"))
+            displayNode = self.volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
+            self._createdNodes.extend([displayNode, displayNode.GetVolumePropertyNode(), displayNode.GetROINode()])
+            displayNode.GetVolumePropertyNode().Copy(self.ctAAAPreset)
             displayNode.SetVisibility(True)
 
             # center 3D view
-            layoutManager = slicer.app.layoutManager()
-            threeDWidget = layoutManager.threeDWidget(0)
-            threeDView = threeDWidget.threeDView()
+            threeDView = self.layoutManager.threeDWidget(0).threeDView()
             threeDView.resetFocalPoint()
 
-            # volume extract threshold 2000
-            thresholdValue = 2000
-            voxels = slicer.util.arrayFromVolume(self.currentVolumeNode)
-            voxels[voxels < thresholdValue] = 0
-            slicer.util.arrayFromVolumeModified(self.currentVolumeNode)
-
             # maximize 3D view
-            layoutManager = slicer.app.layoutManager()
-            layoutLogic = layoutManager.layoutLogic()
+            self.layoutLogic.MaximizeView(threeDView.mrmlViewNode())
+
+    def ReadVolume(self, filepath):
 
-            viewNodes = slicer.util.getNodesByClass("vtkMRMLAbstractViewNode")
-            ThreeViewNode = viewNodes[0]
+        # only touches the file and numpy, so it is safe to run in the prefetch worker thread
+        # nibabel decompresses nifti files much faster than the default slicer reader
+        image = nib.load(filepath)
 
-            layoutLogic.MaximizeView(ThreeViewNode)
+        # scaled data (scl_slope/scl_inter, usual for CT) would come back as float64, read it as float32 instead
+        if image.dataobj.slope == 1 and image.dataobj.inter == 0:
+            return np.asanyarray(image.dataobj), image.affine
+
+        return image.get_fdata(dtype=np.float32), image.affine
+
+    def PrefetchVolume(self, index):
+
+        if 0 <= index < self.total_files and index not in self._prefetchCache:
+            self._prefetchCache[index] = self._prefetchExecutor.submit(self.ReadVolume, self.fileset[index])
+
+    def LoadVolume(self, index, thresholdValue):
+
+        filepath = self.fileset[index]
+
+        if index in self._prefetchCache:
+            voxels, affine = self._prefetchCache[index].result()
+        else:
+            voxels, affine = self.ReadVolume(filepath)
+
+        # keep only the neighbourhood of the current file and decompress the next one while the user looks at this one
+        for cachedIndex in [cachedIndex for cachedIndex in self._prefetchCache if abs(cachedIndex - index) > 2]:
+            del self._prefetchCache[cachedIndex]
+        self.PrefetchVolume(index + 1)
+
+        # nibabel arrays are indexed (i, j, k), slicer arrays (k, j, i)
+        voxels = np.ascontiguousarray(voxels.T)
+
+        # threshold before the voxels are in the scene, so no modified event wakes up the slice views
+        # thresholding twice gives the same result, the cached array of a revisited file can be reused as it is
+        if _load_numba() is not None:
+            _load_numba().thresholdBelow(voxels, thresholdValue)
+        else:
+            for z in range(0, voxels.shape[0], 32): # threshold slab by slab to keep the mask small and in cache
+                slab = voxels[z:z + 32]
+                np.putmask(slab, slab < thresholdValue, 0)
+
+        # every node is tracked as soon as it is in the scene, so RemoveCurrentScene finds it even if loading stops halfway
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", os.path.basename(filepath).removesuffix('.nii.gz'))
+        self._createdNodes.append(volumeNode)
+        slicer.util.updateVolumeFromArray(volumeNode, voxels)
+
+        ijkToRas = vtk.vtkMatrix4x4()
+        for row in range(4):
+            for column in range(4):
+                ijkToRas.SetElement(row, column, affine[row, column])
+        volumeNode.SetIJKToRASMatrix(ijkToRas)
+
+        volumeNode.CreateDefaultDisplayNodes()
+        for index in range(volumeNode.GetNumberOfDisplayNodes()):
+            self._createdNodes.append(volumeNode.GetNthDisplayNode(index))
+        slicer.util.setSliceViewerLayers(background=volumeNode, fit=True)
+
+        return volumeNode
 
     def RemoveCurrentScene(self):
 
-        slicer.mrmlScene.Clear(0)
+        # only remove what this module added instead of clearing the whole scene
+        for node in self._createdNodes:
+            if node:
+                slicer.mrmlScene.RemoveNode(node)
+
+        self._createdNodes.clear()
 
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        self._prefetchExecutor.shutdown(wait=True)
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
@@ -369,6 +479,11 @@ class ImplantVideoWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onSceneEndClose(self, caller, event) -> None:
         """Called just after the scene is closed."""
+        # the loaded nodes are gone, so Load on the same folder has to load again
+        self._lastFilesetKey = None
+        self._createdNodes.clear()
+        self.currentVolumeNode = ""
+
         # If this module is shown while the scene is closed then recreate a new parameter node immediately
         if self.parent.isEntered:
             self.initializeParameterNode()
@@ -399,9 +514,184 @@ class ImplantVideoLogic(ScriptedLoadableModuleLogic):
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
 
+        # ffmpeg codec arguments, probed on the first video
+        self._videoEncoderArguments = None
+
     def getParameterNode(self):
         return ImplantVideoParameterNode(super().getParameterNode())
 
+    def createRotationVideo(self, threeDView, videoFile: str, numberOfFrames: int = 360, frameRate: int = 60) -> None:
+        """
+        Rotate the camera of a 3D view by 360 degrees and encode the rendered frames into a video.
+        Rendering, capturing and encoding happen in one pass, frames are piped to ffmpeg without touching the disk.
+        :param threeDView: 3D view to capture
+        :param videoFile: output mp4 file
+        :param numberOfFrames: number of frames of the full rotation
+        :param frameRate: frames per second of the video
+        """
+
+        viewNode = threeDView.mrmlViewNode()
+        camera = slicer.modules.cameras.logic().GetViewActiveCameraNode(viewNode).GetCamera()
+
+        # one filter for all frames, Modified() makes it read the back buffer again into the same output image
+        windowToImage = vtk.vtkWindowToImageFilter()
+        windowToImage.SetInput(threeDView.renderWindow())
+        windowToImage.SetInputBufferTypeToRGB()
+        windowToImage.ReadFrontBufferOff()
+
+        startRotation = -180
+        endRotation = 180
+        rotationStepSize = (endRotation - startRotation) / max(numberOfFrames - 1, 1)
+
+        # encode into a private temporary folder, the destination folder only ever gets the finished video
+        tempDirectory = tempfile.mkdtemp(prefix="implantvid_")
+        tempVideoFile = os.path.join(tempDirectory, os.path.basename(videoFile))
+
+        ffmpeg = None
+        writer = None
+        encoded = False
+        frames = queue.Queue()
+        freeBuffers = queue.Queue()
+        rotation = 0 # degrees the camera is turned so far, undone at the end whether the video succeeded or not
+
+        try:
+            camera.Azimuth(startRotation)
+            rotation = startRotation
+
+            for index in range(numberOfFrames):
+
+                if index != 0:
+                    camera.Azimuth(rotationStepSize)
+                    rotation += rotationStepSize
+
+                threeDView.forceRender()
+                windowToImage.Modified()
+                windowToImage.Update()
+
+                image = windowToImage.GetOutput()
+                frame = vtk_to_numpy(image.GetPointData().GetScalars())
+
+                if ffmpeg is None:
+                    width, height, _ = image.GetDimensions()
+                    command = [self.ffmpegExecutable(), "-y", "-loglevel", "error",
+                               "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(frameRate), "-i", "-",
+                               "-vf", "vflip,crop=trunc(iw/2)*2:trunc(ih/2)*2", # vtk images are bottom-up, yuv420p needs even size
+                               *self.videoEncoderArguments(), "-pix_fmt", "yuv420p", tempVideoFile]
+
+                    try:
+                        ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+                    except OSError as error:
+                        raise RuntimeError("Failed to start ffmpeg: {}".format(error)) from error
+
+                    # a fixed set of frame buffers cycles between the render loop and the writer, nothing is allocated per frame
+                    for _ in range(8):
+                        freeBuffers.put(np.empty_like(frame))
+
+                    # feed ffmpeg from a worker thread so rendering the next frame overlaps with encoding this one
+                    writer = threading.Thread(target=self._writeFrames, args=(ffmpeg, frames, freeBuffers))
+                    writer.start()
+
+                # the filter output is overwritten by the next frame, hand a copy to the writer
+                buffer = freeBuffers.get()
+                np.copyto(buffer, frame)
+                frames.put(buffer)
+
+            frames.put(None)
+            writer.join()
+            writer = None
+
+            _, error = ffmpeg.communicate()
+            encoded = True
+
+            if ffmpeg.returncode != 0:
+                raise RuntimeError(error.decode(errors='replace'))
+
+            shutil.move(tempVideoFile, videoFile)
+
+        finally:
+            # on failure stop ffmpeg first, so a writer blocked on a full pipe gets an error and sees the end marker
+            if ffmpeg is not None and not encoded:
+                ffmpeg.kill()
+
+            if writer is not None:
+                frames.put(None)
+                writer.join()
+
+            if ffmpeg is not None and not encoded:
+                ffmpeg.communicate()
+
+            # restore camera position
+            camera.Azimuth(-rotation)
+            threeDView.forceRender()
+
+            shutil.rmtree(tempDirectory, ignore_errors=True)
+
+    def _writeFrames(self, ffmpeg, frames, freeBuffers):
+
+        pipeBroken = False
+
+        while True:
+
+            frame = frames.get()
+
+            if frame is None:
+                break
+
+            # keep draining the queue if ffmpeg stopped so the render loop never blocks, the error is reported afterwards
+            if not pipeBroken:
+                try:
+                    ffmpeg.stdin.write(frame)
+                except OSError:
+                    pipeBroken = True
+
+            freeBuffers.put(frame)
+
+    def ffmpegExecutable(self) -> str:
+
+        # imported on first use so opening the module does not pay for it
+        try:
+            import imageio_ffmpeg
+        except:
+            slicer.util.pip_install('imageio-ffmpeg')
+            import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+
+    def videoEncoderArguments(self) -> list:
+
+        if self._videoEncoderArguments is not None:
+            return self._videoEncoderArguments
+
+        # hardware encoders (NVIDIA, AMD, Intel) first, libx264 on the cpu as fallback
+        hardwareEncoders = [
+            ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll", "-rc", "cbr", "-b:v", "8M"],
+            ["-c:v", "h264_amf", "-quality", "speed", "-rc", "cbr", "-b:v", "8M"],
+            ["-c:v", "h264_qsv", "-preset", "veryfast", "-b:v", "8M"],
+        ]
+        self._videoEncoderArguments = ["-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency", "-crf", "20", "-threads", "0"]
+
+        ffmpegExecutable = self.ffmpegExecutable()
+        encoders = subprocess.run([ffmpegExecutable, "-hide_banner", "-encoders"], capture_output=True, text=True).stdout
+
+        for arguments in hardwareEncoders:
+
+            if arguments[1] not in encoders:
+                continue
+
+            # an encoder can be compiled in without a usable device, so encode a short test clip
+            probe = subprocess.run([ffmpegExecutable, "-hide_banner", "-loglevel", "error",
+                                    "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+                                    *arguments, "-pix_fmt", "yuv420p", "-f", "null", "-"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            if probe.returncode == 0:
+                self._videoEncoderArguments = arguments
+                break
+
+        print('video encoder : ', self._videoEncoderArguments[1])
+
+        return self._videoEncoderArguments
+
     def process(self,
                 inputVolume: vtkMRMLScalarVolumeNode,
                 outputVolume: vtkMRMLScalarVolumeNode,
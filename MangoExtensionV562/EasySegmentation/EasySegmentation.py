@@ -1,12 +1,14 @@
+import concurrent.futures
+import functools
 import logging
 import os
 from typing import Annotated, Optional
 
+import numpy as np
 import vtk
+from vtk.util import numpy_support
 import ctk
 import qt
-import glob
-from xml.dom import minidom
 
 import slicer
 from slicer.i18n import tr as _
@@ -21,7 +23,79 @@ from slicer.parameterNodeWrapper import (
 from slicer import vtkMRMLScalarVolumeNode
 
 from pathlib import Path
+import bisect
 import re
+import types
+
+# runs of hyphens and underscores are treated as one '_' when pairing image and segmentation names
+_DASH_RE = re.compile(r"[_-]+")
+
+# numba and numexpr are optional and imported on the first threshold, without them the threshold runs as in-place numpy ufuncs
+_NUMBA_KERNELS = None
+_NUMEXPR = None
+
+def _load_numba():
+    """Compile the threshold kernels on first use. Returns None when numba is not installed."""
+    global _NUMBA_KERNELS
+
+    if _NUMBA_KERNELS is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _NUMBA_KERNELS = False
+            return None
+
+        @njit(parallel=True, fastmath=True, cache=True)
+        def thresholdRange(voxels, lower, upper, out):
+            for index in prange(voxels.size):
+                out[index] = 1 if lower <= voxels[index] <= upper else 0
+
+        @njit(parallel=True, cache=True)
+        def thresholdKeep(voxels, threshold, invert, out):
+            # one read of the input and one write of the output per voxel
+            for index in prange(voxels.size):
+                value = voxels[index]
+                if (value <= threshold) if invert else (value >= threshold):
+                    out[index] = value
+                else:
+                    out[index] = 0
+
+        _NUMBA_KERNELS = types.SimpleNamespace(thresholdRange=thresholdRange, thresholdKeep=thresholdKeep)
+
+    return _NUMBA_KERNELS or None
+
+def _get_numexpr():
+    global _NUMEXPR
+
+    if _NUMEXPR is None:
+        try:
+            import numexpr
+        except ImportError:
+            numexpr = False
+        _NUMEXPR = numexpr
+
+    return _NUMEXPR or None
+
+# volume rendering preset names from Resources/presets.xml, read once
+_PRESET_NAMES = None
+
+def _get_preset_names(presetfile):
+    global _PRESET_NAMES
+
+    if _PRESET_NAMES is None:
+        import xml.etree.ElementTree as ET
+
+        names = []
+
+        # stream the file and drop each preset's subtree as soon as its name is read
+        for event, elem in ET.iterparse(presetfile, events=("end",)):
+            if elem.tag == 'VolumeProperty':
+                names.append(elem.get('name'))
+                elem.clear()
+
+        _PRESET_NAMES = names
+
+    return _PRESET_NAMES
 
 
 #
@@ -87,6 +161,9 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # longest first, so that '.nii.gz' is not cut at '.nii'
+    _EXTS = ('.nii.gz', '.nrrd', '.nii')
+
     def __init__(self, parent=None) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
         ScriptedLoadableModuleWidget.__init__(self, parent)
@@ -98,6 +175,8 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Members
         self.parameterSetNode = None
         self.editor = None
+        self._renderInited = False # volume rendering widgets are created on first use
+        self._editorInited = False # segment editor widget is created on first use
         self.saveDirectory = ""
         self.imageDirectory = ""
         self.segDirectory = ""
@@ -106,6 +185,16 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.needAddProperty = True
         self.changeProperty = False
         self.displayNode = None
+        self.thresholdMask = None # reused upper bound mask of the threshold
+        self.maskImage = None # reused labelmap image the threshold is written into
+        self.maskArray = None # numpy view of the maskImage scalars
+        self._currentNodes = [] # nodes created for the current file, removed on Next/Prev
+        self._observedSegmentation = None # segmentation whose edits refresh the 3D mask
+        self._maskRefreshPending = False
+
+        # file index -> future of a volume node read in the background, not added to the scene yet
+        self.prefetchVolumes = {}
+        self.prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
         self.moduleName = self.__class__.__name__
         if self.moduleName.endswith('Widget'):
@@ -115,8 +204,6 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.slicer_majorVersion = slicer.app.majorVersion
         self.slicer_minorVersion = slicer.app.minorVersion
 
-        self.file_types = ('*.nrrd', '*.nii', '*.nii.gz')
-
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
 
@@ -128,6 +215,13 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         ScriptedLoadableModuleWidget.setup(self)
 
+        # resolved once, the module location does not change while Slicer runs
+        self._presetFile = os.path.join(os.path.dirname(slicer.util.modulePath(self.moduleName)), 'Resources', 'presets.xml')
+        self._volRenLogic = slicer.modules.volumerendering.logic()
+
+        # the preset names are parsed in the background while the user picks folders, MRML stays on this thread
+        self._presetNamesFuture = self.prefetchExecutor.submit(_get_preset_names, self._presetFile)
+
         self.MainCollapsibleButton = ctk.ctkCollapsibleButton()
         self.MainCollapsibleButton.text = "Files"
         self.MainCollapsibleButton.collapsed = 0
@@ -209,14 +303,18 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ThresholdCheck.setChecked(False)
         self.ThresholdCheck.connect('clicked()', self.onThresholdCheck)
 
-        self.minBox = qt.QTextEdit()
-        self.minBox.setFixedSize(50, 23) # Set the size of the widget
-        self.minBox.setText("0.1")
+        self.minBox = qt.QDoubleSpinBox()
+        self.minBox.setFixedSize(90, 23) # Set the size of the widget
+        self.minBox.setRange(-1e9, 1e9)
+        self.minBox.setDecimals(3)
+        self.minBox.setValue(0.1)
         self.minBox.setDisabled(True)
 
-        self.maxBox = qt.QTextEdit()
-        self.maxBox.setFixedSize(50, 23) # Set the size of the widget
-        self.maxBox.setText("100000")
+        self.maxBox = qt.QDoubleSpinBox()
+        self.maxBox.setFixedSize(90, 23) # Set the size of the widget
+        self.maxBox.setRange(-1e9, 1e9)
+        self.maxBox.setDecimals(3)
+        self.maxBox.setValue(100000)
         self.maxBox.setDisabled(True)
 
         self.ApplyButton = qt.QPushButton("Apply")
@@ -247,9 +345,59 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.renderCollapsibleButton.text = "Volume Rendering"
         self.renderCollapsibleButton.collapsed = 1
         self.layout.addWidget(self.renderCollapsibleButton)
-        renderFormLayout = qt.QFormLayout(self.renderCollapsibleButton)
+        self.renderFormLayout = qt.QFormLayout(self.renderCollapsibleButton)
+
+        # the volume rendering widgets are built the first time the section is expanded
+        self.renderCollapsibleButton.connect('contentsCollapsed(bool)', self.onRenderCollapsed)
+
+        #
+        # Segment editor widget
+        #
+
+        # new collapse button
+        self.editorCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.editorCollapsibleButton.text = "Segmentation Editor"
+        self.editorCollapsibleButton.collapsed = 1
+        self.layout.addWidget(self.editorCollapsibleButton)
+        self.editorFormLayout = qt.QFormLayout(self.editorCollapsibleButton)
+
+        # the segment editor is built the first time the section is expanded or a file is loaded
+        self.editorCollapsibleButton.connect('contentsCollapsed(bool)', self.onEditorCollapsed)
+
+        # saved files are written in the background
+        self.artifactWriter = AsyncArtifactWriter()
+
+        verticalSpacer = qt.QSpacerItem(20, 40, qt.QSizePolicy.Minimum, qt.QSizePolicy.Expanding)
+        self.layout.addItem(verticalSpacer)
+
+        # These connections ensure that we update parameter node when scene is closed
+        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartCloseEvent, self.onSceneStartClose)
+        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+
+    def onRenderCollapsed(self, collapsed):
+
+        if not collapsed:
+            self._initRenderingUi()
+
+    def onEditorCollapsed(self, collapsed):
+
+        if not collapsed:
+            self._initEditorUi()
+
+    def _initRenderingUi(self):
+
+        if self._renderInited:
+            return
+
+        self._renderInited = True
+
+        # volume rendering presets by name, so a preset is a dictionary lookup instead of a scene search
+        self._presetByName = {}
+        presetNodes = self._volRenLogic.GetPresetsScene().GetNodesByClass('vtkMRMLVolumePropertyNode')
+        for index in range(presetNodes.GetNumberOfItems()):
+            presetNode = presetNodes.GetItemAsObject(index)
+            self._presetByName.setdefault(presetNode.GetName(), presetNode)
 
-        # volume rendering
         import qSlicerVolumeRenderingModuleWidgetsPythonQt
 
         self.render = qSlicerVolumeRenderingModuleWidgetsPythonQt.qSlicerVolumeRenderingPresetComboBox()
@@ -268,7 +416,7 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.PresetOffsetSlider.connect("valueChanged(double)", self.interaction)
         self.PresetOffsetSlider.connect("sliderReleased", self.endInteraction)
 
-        renderFormLayout.addRow(self.render)
+        self.renderFormLayout.addRow(self.render)
 
         self.RenderButton = qt.QPushButton("Display Volume Rendering")
         self.RenderButton.toolTip = "display volume rendering button"
@@ -278,43 +426,39 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.RenderButton.enabled = False
 
-        renderFormLayout.addRow(createHLayout([self.RenderButton]))
+        self.MaskCheck = qt.QCheckBox("Mask by segment")
+        self.MaskCheck.toolTip = "render only the voxels inside the current segment"
+        self.MaskCheck.setChecked(False)
+        self.MaskCheck.connect('clicked()', self.onRendering)
 
+        rowLayout = qt.QHBoxLayout()
+        rowLayout.addWidget(self.RenderButton)
+        rowLayout.addWidget(self.MaskCheck)
+        self.renderFormLayout.addRow(rowLayout)
 
-        #
-        # Segment editor widget
-        #
+    def _initEditorUi(self):
+
+        if self._editorInited:
+            return
+
+        self._editorInited = True
 
-        # new collapse button
-        self.editorCollapsibleButton = ctk.ctkCollapsibleButton()
-        self.editorCollapsibleButton.text = "Segmentation Editor"
-        self.editorCollapsibleButton.collapsed = 1
-        self.layout.addWidget(self.editorCollapsibleButton)
-        editorFormLayout = qt.QFormLayout(self.editorCollapsibleButton)
-        
         import qSlicerSegmentationsModuleWidgetsPythonQt
         self.editor = qSlicerSegmentationsModuleWidgetsPythonQt.qMRMLSegmentEditorWidget()
         self.editor.setMaximumNumberOfUndoStates(10)
 
         self.editor.setMRMLScene(slicer.mrmlScene)
 
-        editorFormLayout.addRow(self.editor)
+        self.editorFormLayout.addRow(self.editor)
 
         self.selectParameterNode()
 
-        verticalSpacer = qt.QSpacerItem(20, 40, qt.QSizePolicy.Minimum, qt.QSizePolicy.Expanding)
-        self.layout.addItem(verticalSpacer)
-
         # Observe editor effect registrations to make sure that any effects that are registered
         # later will show up in the segment editor widget. For example, if Segment Editor is set
         # as startup module, additional effects are registered after the segment editor widget is created.
         self.effectFactorySingleton = slicer.qSlicerSegmentEditorEffectFactory.instance()
         self.effectFactorySingleton.connect('effectRegistered(QString)', self.editorEffectRegistered)
 
-        # These connections ensure that we update parameter node when scene is closed
-        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartCloseEvent, self.onSceneStartClose)
-        self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
-
     def selectParameterNode(self):
             # Select parameter set node if one is found in the scene, and create one otherwise
             segmentEditorSingletonTag = "SegmentEditor"
@@ -350,8 +494,11 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onApply(self):
 
-        minValue = self.minBox.toPlainText()
-        maxValue = self.maxBox.toPlainText()
+        self._applyThreshold()
+
+    def _applyThreshold(self):
+
+        # the one threshold path, used by the Apply button and by LoadFiles for files without segmentation
         segmentId = self.currentSegNode.GetSegmentation().GetSegmentIdBySegmentName('Segment_1')
 
         if segmentId == "":
@@ -359,14 +506,108 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         else:
             self.NewSegmentId = segmentId
 
-        # Get segment as numpy array
-        segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(self.currentSegNode, self.NewSegmentId, self.currentVolumeNode)
-
-        # Modify the segmentation
-        segmentArray[:] = 0  # clear the segmentation
         volumeArray = slicer.util.arrayFromVolume(self.currentVolumeNode)
-        segmentArray[(volumeArray >= float(minValue)) & (volumeArray <= float(maxValue))  ] = 1  # create segment by simple thresholding of an image
-        slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, self.currentSegNode, self.NewSegmentId, self.currentVolumeNode)
+        segmentArray = self.prepareMaskImage(volumeArray.shape)
+        bounds = self.thresholdBounds(volumeArray.dtype)
+        minValue, maxValue = bounds if bounds is not None else (None, None)
+
+        # create segment by simple thresholding of an image, written straight into the segment array (0/1 bytes)
+        if bounds is None:
+            segmentArray.fill(0)
+        elif _load_numba() is not None:
+            _load_numba().thresholdRange(volumeArray.ravel(), minValue, maxValue, segmentArray.ravel())
+        elif _get_numexpr() is not None:
+            _get_numexpr().evaluate("(v >= lo) & (v <= hi)", local_dict={'v': volumeArray, 'lo': minValue, 'hi': maxValue}, out=segmentArray.view(bool))
+        else:
+            if self.thresholdMask is None or self.thresholdMask.shape != volumeArray.shape:
+                self.thresholdMask = np.empty(volumeArray.shape, dtype=bool)
+
+            segmentMask = segmentArray.view(bool)
+            np.greater_equal(volumeArray, minValue, out=segmentMask)
+            np.less_equal(volumeArray, maxValue, out=self.thresholdMask)
+            np.logical_and(segmentMask, self.thresholdMask, out=segmentMask)
+
+        self.maskImage.Modified()
+        # only the bounding box is copied, but the whole volume extent is replaced so voxels outside the box are cleared.
+        # the segment modified event of the replace refreshes the 3D mask
+        labelmap = self.croppedMaskImage()
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmap, self.currentSegNode, self.NewSegmentId,
+                                                                           slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, self.maskImage.GetExtent())
+
+    def thresholdBounds(self, dtype):
+
+        # compare in the volume's own dtype, so numpy does not upcast every voxel to float64.
+        # integer volumes round the bounds inwards and clip them to the dtype range, None means nothing can match
+        minValue = self.minBox.value
+        maxValue = self.maxBox.value
+
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            minValue = int(np.ceil(minValue))
+            maxValue = int(np.floor(maxValue))
+
+            if minValue > info.max or maxValue < info.min:
+                return None
+
+            minValue = max(minValue, info.min)
+            maxValue = min(maxValue, info.max)
+
+        else:
+            # the boxes show a few decimals, a bound stands for every value that rounds to it, so a voxel
+            # that looks inside the range on screen is never dropped by the hidden digits
+            minValue -= 0.5 * 10 ** -self.minBox.decimals
+            maxValue += 0.5 * 10 ** -self.maxBox.decimals
+
+        return dtype.type(minValue), dtype.type(maxValue)
+
+    def prepareMaskImage(self, shape):
+
+        imageData = self.currentVolumeNode.GetImageData()
+
+        # the labelmap is allocated once per volume size and written through a numpy view of its scalars
+        if self.maskImage is None or self.maskImage.GetExtent() != imageData.GetExtent():
+            self.maskImage = slicer.vtkOrientedImageData()
+            self.maskImage.SetExtent(imageData.GetExtent())
+            self.maskImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+            self.maskArray = numpy_support.vtk_to_numpy(self.maskImage.GetPointData().GetScalars()).reshape(shape)
+
+        ijkToRas = vtk.vtkMatrix4x4()
+        self.currentVolumeNode.GetIJKToRASMatrix(ijkToRas)
+        self.maskImage.SetImageToWorldMatrix(ijkToRas)
+
+        return self.maskArray
+
+    def croppedMaskImage(self):
+
+        # only the bounding box of the thresholded voxels is copied into a new labelmap
+        sliceAny = self.maskArray.any(axis=(1, 2))
+        if not sliceAny.any():
+            return self.maskImage
+
+        planeAny = self.maskArray.any(axis=0)
+        rowAny = planeAny.any(axis=1)
+        columnAny = planeAny.any(axis=0)
+
+        k0, k1 = np.flatnonzero(sliceAny)[[0, -1]]
+        j0, j1 = np.flatnonzero(rowAny)[[0, -1]]
+        i0, i1 = np.flatnonzero(columnAny)[[0, -1]]
+
+        if (k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1) == self.maskArray.shape:
+            return self.maskImage
+
+        fullExtent = self.maskImage.GetExtent()
+        croppedImage = slicer.vtkOrientedImageData()
+        croppedImage.SetExtent(fullExtent[0] + i0, fullExtent[0] + i1, fullExtent[2] + j0, fullExtent[2] + j1, fullExtent[4] + k0, fullExtent[4] + k1)
+        croppedImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+
+        imageToWorld = vtk.vtkMatrix4x4()
+        self.maskImage.GetImageToWorldMatrix(imageToWorld)
+        croppedImage.SetImageToWorldMatrix(imageToWorld)
+
+        croppedArray = numpy_support.vtk_to_numpy(croppedImage.GetPointData().GetScalars()).reshape(k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1)
+        croppedArray[:] = self.maskArray[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1]
+
+        return croppedImage
 
     def onRenderingCheck(self):
 
@@ -378,11 +619,66 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             if self.displayNode:
                 self.displayNode.SetVisibility(1)
+                self.setRenderingMask()
 
         else:
             if self.displayNode:
                 self.displayNode.SetVisibility(0)
 
+    def setRenderingMask(self):
+
+        threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
+        displayableManager = threeDView.displayableManagerByClassName('vtkMRMLVolumeRenderingDisplayableManager')
+        volumeActor = displayableManager.GetVolumeActor(self.displayNode) if displayableManager else None
+
+        # only the GPU ray cast mapper can mask, it reads the labelmap as a 3D texture so no surface is built
+        mapper = volumeActor.GetMapper() if volumeActor else None
+        if mapper is None or not hasattr(mapper, 'SetMaskType'):
+            return
+
+        segmentation = self.currentSegNode.GetSegmentation()
+        segmentId = self.editor.currentSegmentID() or (segmentation.GetNthSegmentID(0) if segmentation.GetNumberOfSegments() else "")
+
+        if not self.MaskCheck.isChecked() or segmentId == "":
+            mapper.SetMaskInput(None)
+
+        else:
+            # mapper input is the volume image data in IJK space, the mask has to share its extent
+            segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(self.currentSegNode, segmentId, self.currentVolumeNode)
+            renderMask = vtk.vtkImageData()
+            renderMask.SetExtent(self.currentVolumeNode.GetImageData().GetExtent())
+            renderMask.GetPointData().SetScalars(numpy_support.numpy_to_vtk(segmentArray.ravel().astype(np.uint8, copy=False), deep=True))
+
+            mapper.SetMaskType(vtk.vtkGPUVolumeRayCastMapper.BinaryMaskType)
+            mapper.SetMaskInput(renderMask)
+
+        threeDView.scheduleRender()
+
+    def observeSegmentation(self, segmentationNode):
+
+        # edits of the current segment, by Apply or by the editor effects, refresh the 3D mask
+        if self._observedSegmentation is not None:
+            self.removeObserver(self._observedSegmentation, slicer.vtkSegmentation.SegmentModified, self.onSegmentModified)
+
+        self._observedSegmentation = segmentationNode.GetSegmentation()
+        self.addObserver(self._observedSegmentation, slicer.vtkSegmentation.SegmentModified, self.onSegmentModified)
+
+    def onSegmentModified(self, caller, event):
+
+        # an editor stroke fires many events, the mask is rebuilt once after them
+        if self._maskRefreshPending:
+            return
+
+        self._maskRefreshPending = True
+        qt.QTimer.singleShot(0, self._refreshRenderingMask)
+
+    def _refreshRenderingMask(self):
+
+        self._maskRefreshPending = False
+
+        if self.RenderButton.isChecked() and self.MaskCheck.isChecked() and self.displayNode and self.displayNode.GetScene():
+            self.setRenderingMask()
+
     def onPresetCombo(self, id):
 
         if self.needAddProperty == False:
@@ -400,7 +696,14 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 
             else:
 
-                self.newPresetNode = slicer.mrmlScene.GetNodeByID(id)
+                # node IDs are only unique within one scene, resolve the ID in the scene the combo box lists
+                presetNode = self.PresetComboBox.mrmlScene().GetNodeByID(id)
+                presetIndex = self.presetIndexOfNode(presetNode)
+
+                if presetIndex is None:
+                    self.newPresetNode = presetNode
+                else:
+                    self.newPresetNode = self._getPresetNode(presetIndex)
 
                 if self.currentPresetNode == self.newPresetNode:
                     return
@@ -412,6 +715,36 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         else:
             return
 
+    def presetIndexOfNode(self, presetNode):
+
+        # a preset already added to our scene matches by node, a node of the presets scene by its name
+        if presetNode is None:
+            return None
+
+        if presetNode in self.preset_nodes:
+            return self.preset_nodes.index(presetNode)
+
+        if presetNode.GetName() not in self.preset_names:
+            return None
+
+        return self.preset_names.index(presetNode.GetName())
+
+    def _getPresetNode(self, index):
+
+        presetNode = self.preset_nodes[index]
+
+        if presetNode is None:
+            name = self.preset_names[index]
+            presetNode = self._presetByName.get(name) or self._volRenLogic.GetPresetByName(name)
+
+            # presets stay in the scene from one file to the next, only add the ones that are not there yet
+            if presetNode.GetScene() is not slicer.mrmlScene:
+                presetNode = slicer.mrmlScene.AddNode(presetNode)
+
+            self.preset_nodes[index] = presetNode
+
+        return presetNode
+
     def startInteraction(self):
         if self.volumePropertyNode:
             self.volumePropertyNode.InvokeEvent(vtk.vtkCommand.StartInteractionEvent)
@@ -495,7 +828,7 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onFileCombo(self, index):
 
-            if self.editor.segmentationNodeID():
+            if self._editorInited and self.editor.segmentationNodeID():
                 self.RemoveCurrentScene()
 
             if self.total_files != 0:
@@ -504,12 +837,17 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def InsertFileCombo(self):
 
-            for index in range(self.total_files):
+            image_names = [self.find_basename_wo_extension(files[0]) for files in self.fileset]
 
-                image_basename = os.path.basename(self.fileset[index][0])
-                image_name = self.find_basename_wo_extension(self.fileset[index][0])
+            # fill the list without a currentIndexChanged per item, then load the first file once
+            self.FileComboBox.blockSignals(True)
+            self.FileComboBox.clear()
+            self.FileComboBox.addItems(image_names)
+            self.FileComboBox.blockSignals(False)
 
-                self.FileComboBox.addItem(image_name)
+            if self.total_files != 0:
+                self.FileComboBox.setCurrentIndex(0)
+                self.onFileCombo(0)
 
     def RemoveCurrentNodes(self):
 
@@ -518,7 +856,26 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def RemoveCurrentScene(self):
 
-            slicer.mrmlScene.Clear(0)
+            # remove only what LoadFiles added, the rest of the scene is kept for the next file
+            for node in reversed(self._currentNodes):
+                if node.GetScene():
+                    slicer.mrmlScene.RemoveNode(node)
+
+            self._currentNodes = []
+
+    def trackCurrentNode(self, node):
+
+            if node is None:
+                return
+
+            self._currentNodes.append(node)
+
+            if node.IsA('vtkMRMLDisplayableNode'):
+                for index in range(node.GetNumberOfDisplayNodes()):
+                    self._currentNodes.append(node.GetNthDisplayNode(index))
+
+            if node.IsA('vtkMRMLStorableNode') and node.GetStorageNode():
+                self._currentNodes.append(node.GetStorageNode())
 
     def onReset(self):
 
@@ -528,13 +885,14 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.imageDirectory = ""
             self.segDirectory = ""
             self.fileset = []
+            self.prefetchVolumes.clear()
             self.FileComboBox.clear()
             self.ImageCheck.setChecked(0)
             self.SegCheck.setChecked(1)
             self.RenderCheck.setChecked(0)
 
-            self.minBox.setText("0.1") 
-            self.maxBox.setText("100000")
+            self.minBox.setValue(0.1)
+            self.maxBox.setValue(100000)
 
             self.minBox.setDisabled(True)
             self.maxBox.setDisabled(True)
@@ -546,59 +904,47 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             self.needAddProperty = True
             self.changeProperty = False
-            self.RenderButton.enabled = False
-            self.render.enabled = False
+            if self._renderInited:
+                self.RenderButton.enabled = False
+                self.render.enabled = False
 
             self.DirButton.setText(self.saveDirectory)
             self.editorCollapsibleButton.collapsed = 1
             self.renderCollapsibleButton.collapsed = 1
 
+            self._currentNodes = []
             slicer.mrmlScene.Clear(0)
 
     def onRun(self):
 
             # check directory
-            image_files = []
-            seg_files = []
-
-            for files in self.file_types:
-
-                image_files.extend(sorted(glob.glob(os.path.join(self.imageDirectory, files))))
-                seg_files.extend(sorted(glob.glob(os.path.join(self.segDirectory, files))))
+            image_files = self.scan_files(self.imageDirectory)
+            seg_files = self.scan_files(self.segDirectory)
 
             self.fileset = []
 
             num_onlyImage = 0
 
+            # index segmentation files by their unified name once instead of comparing every image with every segmentation
+            seg_index = SegmentationNameIndex(seg_files, lambda seg_file: _DASH_RE.sub('_', self.find_basename_wo_extension(seg_file))) # unify confuse hypen or dash characters.
+
             # find corresponding files
             for image_file in image_files:
 
-                    Is_Seg_Found = False
-
-                    image_basename = os.path.basename(image_file)
-                    image_name = self.find_basename_wo_extension(image_file)
+                    image_name = _DASH_RE.sub('_', self.find_basename_wo_extension(image_file))
 
-                    image_name = re.sub(r"[_-]+", '_', image_name) # unify confuse hypen or dash characters.
+                    seg_file = seg_index.find_seg_file(image_name)
 
-                    for seg_file in seg_files:
-
-                        seg_basename = os.path.basename(seg_file)
-                        seg_name = self.find_basename_wo_extension(seg_file)
-
-                        seg_name = re.sub(r"[_-]+", '_', seg_name)
-
-                        if (image_name in seg_name) or (seg_name in image_name):
-                            self.fileset.append([image_file, seg_file])
-                            Is_Seg_Found = True
-                            break
-
-                    if Is_Seg_Found == False:
+                    if seg_file is None:
                         self.fileset.append([image_file, ""])
                         num_onlyImage += 1
+                    else:
+                        self.fileset.append([image_file, seg_file])
 
 
             self.total_files = len(self.fileset)
             self.current_file = 0
+            self.prefetchVolumes.clear()
 
             self.editorCollapsibleButton.collapsed = 0
 
@@ -611,14 +957,28 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             #load first file
             #self.LoadFiles()
 
-    def find_basename_wo_extension(self, filepath):
+    def scan_files(self, directory):
+
+        if directory == "":
+            return []
+
+        # one pass over the directory for all file types
+        return sorted(entry.path for entry in os.scandir(directory) if entry.name.lower().endswith(self._EXTS) and entry.is_file())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def find_basename_wo_extension(filepath):
 
         file_basename = os.path.basename(filepath)
+        lower_basename = file_basename.lower()
 
-        for types in self.file_types:
+        if not lower_basename.endswith(EasySegmentationWidget._EXTS):
+            return file_basename
 
-            if file_basename.find(types[1:]) != -1:
-                return file_basename[:file_basename.find(types[1:])]
+        for extension in EasySegmentationWidget._EXTS:
+
+            if lower_basename.endswith(extension):
+                return file_basename[:-len(extension)]
 
         return file_basename
 
@@ -647,12 +1007,7 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     volumeFileName = self.find_basename_wo_extension(self.fileset[self.current_file][0])
                     volume_path = os.path.join(volume_directory, volumeFileName + ".nii.gz")
 
-                    if self.slicer_majorVersion >= 5 and self.slicer_minorVersion >= 2:
-                        slicer.util.exportNode(self.currentVolumeNode, volume_path)
-
-                    else:
-                        slicer.util.saveNode(self.currentVolumeNode, volume_path)
-                    
+                    self.artifactWriter.write(self.currentVolumeNode, volume_path)
 
                 if self.SegCheck.isChecked():
 
@@ -679,11 +1034,8 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     else:
                         seg_path = os.path.join(seg_directory, segFileName + ".nii.gz")
 
-                    
-                    if self.slicer_majorVersion >= 5 and self.slicer_minorVersion >= 2:
-                        slicer.util.exportNode(labelmapVolumeNode, seg_path)
-                    else:
-                        slicer.util.saveNode(labelmapVolumeNode, seg_path)
+                    # the writer keeps its own copy of the labelmap, so the temporary node can be removed right away
+                    self.artifactWriter.write(labelmapVolumeNode, seg_path)
 
                     slicer.mrmlScene.RemoveNode(labelmapVolumeNode.GetDisplayNode().GetColorNode())
                     slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
@@ -694,6 +1046,9 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.needAddProperty = True
             self.changeProperty = False
 
+            self._initRenderingUi()
+            self._initEditorUi()
+
             if self.RenderButton.isChecked():
                 self.RenderButton.click()
 
@@ -715,11 +1070,15 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 image_name = self.find_basename_wo_extension(self.fileset[self.current_file][0])
 
                 # load volume node and segmentation node
-                self.currentVolumeNode = slicer.util.loadVolume(self.fileset[self.current_file][0])
+                # every node is tracked as soon as it is in the scene, so RemoveCurrentScene finds it even if loading stops halfway
+                self.currentVolumeNode = self.load_volume(self.current_file)
+                self.trackCurrentNode(self.currentVolumeNode)
                 self.currentVolumeNode.SetName(image_name)
 
                 if self.fileset[self.current_file][1] != "":
                     self.currentSegNode = slicer.util.loadSegmentation(self.fileset[self.current_file][1])
+                    self.trackCurrentNode(self.currentSegNode)
+                    self.observeSegmentation(self.currentSegNode)
                     self.editor.setSegmentationNode(self.currentSegNode)
 
                     self.ThresholdCheck.setDisabled(True)
@@ -734,38 +1093,24 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     
                     self.currentSegNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
                     self.currentSegNode.CreateDefaultDisplayNodes() # only needed for display
+                    self.trackCurrentNode(self.currentSegNode)
                     self.currentSegNode.SetName(image_name)
                     self.currentSegNode.SetReferenceImageGeometryParameterFromVolumeNode(self.currentVolumeNode)
+                    self.observeSegmentation(self.currentSegNode)
 
                     self.editor.setSegmentationNode(self.currentSegNode)
                     self.editor.setSourceVolumeNode(self.currentVolumeNode)
 
-                    volumeArray = slicer.util.arrayFromVolume(self.currentVolumeNode)
-                    maxVolume = volumeArray.max()
+                    # scalar range is cached by vtk, no need to scan the voxels
+                    maxVolume = self.currentVolumeNode.GetImageData().GetScalarRange()[1]
 
-                    # self.minBox.setText("0.1") # keep previous minimum value
-                    self.maxBox.setText("{}".format(maxVolume))
+                    # self.minBox.setValue(0.1) # keep previous minimum value
+                    # rounded up at the box precision, so the brightest voxel of a float volume stays inside the range
+                    scale = 10 ** self.maxBox.decimals
+                    self.maxBox.setValue(np.ceil(maxVolume * scale) / scale)
 
                     if self.ThresholdCheck.isChecked():
-
-                        minValue = self.minBox.toPlainText()
-                        maxValue = self.maxBox.toPlainText()
-
-                        segmentId = self.currentSegNode.GetSegmentation().GetSegmentIdBySegmentName('Segment_1')
-
-                        if segmentId == "":
-                            self.NewSegmentId = self.currentSegNode.GetSegmentation().AddEmptySegment('Segment_1')
-                        else:
-                            self.NewSegmentId = segmentId
-                    
-                        # Get segment as numpy array
-                        segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(self.currentSegNode, self.NewSegmentId, self.currentVolumeNode)
-
-                        # Modify the segmentation
-                        segmentArray[:] = 0  # clear the segmentation
-                        
-                        segmentArray[(volumeArray >= float(minValue)) & (volumeArray <= float(maxValue))  ] = 1  # create segment by simple thresholding of an image
-                        slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, self.currentSegNode, self.NewSegmentId, self.currentVolumeNode)
+                        self._applyThreshold()
 
                 if self.slicer_majorVersion >= 5 and self.slicer_minorVersion >= 2:
                     self.editor.setSourceVolumeNode(self.currentVolumeNode)
@@ -773,37 +1118,53 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     self.editor.setMasterVolumeNode(self.currentVolumeNode)
 
                 #run volume rendering
+                # scene changes below are batched into one render, the view itself is finished after this event
+                slicer.app.pauseRender()
+                try:
+                    self.setupVolumeRendering()
+                finally:
+                    slicer.app.resumeRender()
+
+                displayNode = self.displayNode
+                qt.QTimer.singleShot(0, lambda: self._finishRenderSetup(displayNode))
+
+    def setupVolumeRendering(self):
+
+            names = self._presetNamesFuture.result()
+
+        #     volRenLogic = slicer.modules.volumerendering.logic()
+        # displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
+        # displayNode.GetVolumePropertyNode().Copy(volRenLogic.GetPresetByName("CT-AAA"))
+        # displayNode.SetVisibility(True)
+
+            self.render.enabled = True
+            self.RenderButton.enabled = True
+            self.displayNode = self._volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
+            self.trackCurrentNode(self.displayNode)
+            self.trackCurrentNode(self.displayNode.GetVolumePropertyNode())
+            self.trackCurrentNode(self.displayNode.GetROINode())
+            # self.displayNode.GetVolumePropertyNode().Copy(volRenLogic.GetPresetByName("CT-AAA"))
+            self.volumePropertyNode = self.displayNode.GetVolumePropertyNode()
+            self.render.setMRMLVolumePropertyNode(self.volumePropertyNode)
+            
+            # presets are added to the scene when they are first selected, only the first one now
+            self.preset_names = list(names)
+            self.preset_nodes = [None] * len(self.preset_names)
+
+            self.needAddProperty = False
+            
+            self.currentPresetNode = self._getPresetNode(0)
+            self.render.setCurrentNode(self.currentPresetNode)
+
+    def _finishRenderSetup(self, displayNode):
+
+            # the user may already have moved to another file
+            if displayNode is not self.displayNode or displayNode.GetScene() is None:
+                return
+
+            slicer.app.pauseRender()
+            try:
                 self.renderCollapsibleButton.collapsed = 0
-                scriptedModulesPath = os.path.dirname(slicer.util.modulePath(self.moduleName))
-                presetfile = os.path.join(scriptedModulesPath, 'Resources', "presets.xml")
-                mydoc = minidom.parse(presetfile)
-
-                items = mydoc.getElementsByTagName('VolumeProperty')
-
-            #     volRenLogic = slicer.modules.volumerendering.logic()
-            # displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
-            # displayNode.GetVolumePropertyNode().Copy(volRenLogic.GetPresetByName("CT-AAA"))
-            # displayNode.SetVisibility(True)
-
-                self.render.enabled = True
-                self.RenderButton.enabled = True
-                volRenLogic = slicer.modules.volumerendering.logic()
-                self.displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(self.currentVolumeNode)
-                # self.displayNode.GetVolumePropertyNode().Copy(volRenLogic.GetPresetByName("CT-AAA"))
-                self.volumePropertyNode = self.displayNode.GetVolumePropertyNode()
-                self.render.setMRMLVolumePropertyNode(self.volumePropertyNode)
-                
-                # add presets
-                self.preset_nodes = []
-                for item in items:
-                    preset = volRenLogic.GetPresetByName(item.attributes['name'].value)
-                    self.preset_nodes.append(slicer.mrmlScene.AddNode(preset))
-                    # self.volumePropertyNode.Copy(self.preset_nodes[-1])
-
-                self.needAddProperty = False
-                
-                self.currentPresetNode = self.preset_nodes[0]
-                self.render.setCurrentNode(self.preset_nodes[0])
 
                 # Center the 3D view on the scene
                 layoutManager = slicer.app.layoutManager()
@@ -811,13 +1172,60 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 threeDView = threeDWidget.threeDView()
                 threeDView.resetFocalPoint()
 
-                if self.RenderCheck.isChecked():
-                    self.displayNode.SetVisibility(1)
-                    self.RenderButton.setChecked(1)
+                # one Modified event for the display node whichever way the check box is set
+                wasModified = displayNode.StartModify()
+                visible = 1 if self.RenderCheck.isChecked() else 0
+                displayNode.SetVisibility(visible)
+                self.RenderButton.setChecked(visible)
+                displayNode.EndModify(wasModified)
 
-                else:
-                    self.displayNode.SetVisibility(0)					
-                    self.RenderButton.setChecked(0)
+                # the GPU mapper exists once the node is visible, the mask of the loaded segment is set on it now
+                if visible:
+                    self.setRenderingMask()
+            finally:
+                slicer.app.resumeRender()
+
+    def read_volume_node(self, filepath):
+
+            # the node is not in the scene yet, so reading it is safe in the prefetch worker thread
+            volumeNode = slicer.vtkMRMLScalarVolumeNode()
+            storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+            storageNode.SetFileName(filepath)
+
+            if not storageNode.ReadData(volumeNode):
+                raise RuntimeError("Failed to read {}".format(filepath))
+
+            return volumeNode, storageNode
+
+    def _addVolumeNode(self, volumeNode, storageNode):
+
+            # the storage node stays attached, as with loadVolume, so the volume keeps its file name
+            slicer.mrmlScene.AddNode(storageNode)
+            volumeNode.SetAndObserveStorageNodeID(storageNode.GetID())
+            slicer.mrmlScene.AddNode(volumeNode)
+            volumeNode.CreateDefaultDisplayNodes()
+            slicer.util.setSliceViewerLayers(background=volumeNode, fit=True)
+
+            return volumeNode
+
+    def load_volume(self, index):
+
+            future = self.prefetchVolumes.pop(index, None)
+
+            if future is None:
+                # the scanned formats are read by the archetype storage node directly, without probing every IO manager reader
+                volumeNode = self._addVolumeNode(*self.read_volume_node(self.fileset[index][0]))
+            else:
+                volumeNode = self._addVolumeNode(*future.result())
+
+            # read the next file while the user works on this one
+            for prefetchIndex in [prefetchIndex for prefetchIndex in self.prefetchVolumes if prefetchIndex != index + 1]:
+                del self.prefetchVolumes[prefetchIndex]
+
+            if index + 1 < self.total_files and index + 1 not in self.prefetchVolumes:
+                self.prefetchVolumes[index + 1] = self.prefetchExecutor.submit(self.read_volume_node, self.fileset[index + 1][0])
+
+            return volumeNode
 
     def editorEffectRegistered(self):
             self.editor.updateEffectList()
@@ -843,13 +1251,16 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        self.artifactWriter.shutdown()
+        self.prefetchExecutor.shutdown(wait=True)
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
         # Make sure parameter node exists and observed
         # Set parameter set node if absent
-        self.selectParameterNode()
-        self.editor.updateWidgetFromMRML()
+        if self._editorInited:
+            self.selectParameterNode()
+            self.editor.updateWidgetFromMRML()
 
     def exit(self) -> None:
         """Called each time the user opens a different module."""
@@ -862,17 +1273,153 @@ class EasySegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def onSceneStartClose(self, caller, event) -> None:
         """Called just before the scene is closed."""
         # Parameter node will be reset, do not use it anymore
-        self.selectParameterNode()
-        self.editor.updateWidgetFromMRML()
+        if self._editorInited:
+            self.selectParameterNode()
+            self.editor.updateWidgetFromMRML()
 
     def onSceneEndClose(self, caller, event) -> None:
         """Called just after the scene is closed."""
         # If this module is shown while the scene is closed then recreate a new parameter node immediately
-        if self.parent.isEntered:
+        if self.parent.isEntered and self._editorInited:
             self.selectParameterNode()
             self.editor.updateWidgetFromMRML()
 
 
+#
+# AsyncArtifactWriter
+#
+
+
+class AsyncArtifactWriter:
+    """Writes volume nodes to files in a background thread so saving does not block the GUI.
+    The node is copied on the main thread into a node that is not part of the scene and only
+    that copy is touched by the worker thread. Files are written one after another.
+    """
+
+    def __init__(self) -> None:
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pendingWrites = []
+
+        # completion is reported from the main thread
+        self._timer = qt.QTimer()
+        self._timer.setInterval(200)
+        self._timer.connect('timeout()', self._reportFinishedWrites)
+
+    def write(self, volumeNode, filepath: str) -> None:
+        """
+        Snapshot the volume node and write the snapshot to a file in the background.
+        :param volumeNode: scalar or labelmap volume node to save
+        :param filepath: output file, the extension selects the file format
+        """
+
+        nodeCopy = slicer.mrmlScene.CreateNodeByClass(volumeNode.GetClassName())
+        nodeCopy.UnRegister(None)
+        nodeCopy.SetName(volumeNode.GetName())
+        nodeCopy.CopyOrientation(volumeNode)
+
+        imageData = vtk.vtkImageData()
+        imageData.DeepCopy(volumeNode.GetImageData())
+        nodeCopy.SetAndObserveImageData(imageData)
+
+        storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+        storageNode.SetFileName(filepath)
+        storageNode.SetUseCompression(True)
+
+        future = self._executor.submit(storageNode.WriteData, nodeCopy)
+
+        # keep the copies alive until the file is written
+        self._pendingWrites.append((future, filepath, nodeCopy, storageNode))
+        self._timer.start()
+
+    def shutdown(self) -> None:
+        """Wait for all pending files to be written."""
+        self._executor.shutdown(wait=True)
+        self._reportFinishedWrites()
+
+    def _reportFinishedWrites(self) -> None:
+        for pendingWrite in [pendingWrite for pendingWrite in self._pendingWrites if pendingWrite[0].done()]:
+            self._pendingWrites.remove(pendingWrite)
+            future, filepath = pendingWrite[0], pendingWrite[1]
+
+            if future.exception() is None and future.result():
+                slicer.util.showStatusMessage(f"Saved {filepath}", 3000)
+            else:
+                logging.error(f"Failed to save {filepath}: {future.exception()}")
+                slicer.util.warningDisplay('Failed to save file\n{}'.format(filepath), windowTitle='Mangomedcial')
+
+        if not self._pendingWrites:
+            self._timer.stop()
+
+
+#
+# SegmentationNameIndex
+#
+
+
+class SegmentationNameIndex:
+    """Segmentation files by name, for pairing each image with its segmentation.
+    The names are indexed once, so an image is paired by dictionary lookups, a bisect and
+    one substring search instead of being compared with every segmentation name.
+    """
+
+    def __init__(self, seg_files, name_of) -> None:
+        self._files = {}
+        for seg_file in seg_files:
+            self._files.setdefault(name_of(seg_file), seg_file)
+
+        self._names = sorted(self._files)
+
+        # all names in sorted order in one string, the first hit of str.find is in the first containing name
+        self._text = '\0'.join(self._names)
+        self._starts = []
+        position = 0
+        for name in self._names:
+            self._starts.append(position)
+            position += len(name) + 1
+
+    def find_seg_file(self, image_name: str) -> Optional[str]:
+        """Returns the segmentation file of the image name, or None if there is none."""
+
+        # same name
+        if image_name in self._files:
+            return self._files[image_name]
+
+        # segmentation name starts with the image name (e.g. image "case1", segmentation "case1_seg"),
+        # the sorted names starting with image_name are one contiguous block, prefer the shortest (closest) one
+        candidates = []
+        position = bisect.bisect_left(self._names, image_name)
+        while position < len(self._names) and self._names[position].startswith(image_name):
+            candidates.append(self._names[position])
+            position += 1
+
+        if candidates:
+            return self._files[min(candidates, key=len)]
+
+        # image name starts with the segmentation name, prefer the longest prefix
+        for length in range(len(image_name) - 1, 0, -1):
+            if image_name[:length] in self._files:
+                return self._files[image_name[:length]]
+
+        # any other containment, the first name in sorted order wins.
+        # names containing the image name are found by one search of the joined names,
+        # names contained in the image name by looking up each of its substrings
+        candidates = []
+
+        found = self._text.find(image_name) if image_name and '\0' not in image_name else -1
+        if found >= 0:
+            candidates.append(self._names[bisect.bisect_right(self._starts, found) - 1])
+
+        for start in range(1, len(image_name)):
+            for end in range(start + 1, len(image_name) + 1):
+                if image_name[start:end] in self._files:
+                    candidates.append(image_name[start:end])
+
+        if candidates:
+            return self._files[min(candidates)]
+
+        return None
+
+
 #
 # EasySegmentationLogic
 #
@@ -891,10 +1438,20 @@ class EasySegmentationLogic(ScriptedLoadableModuleLogic):
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
+        self._mask = None # voxels kept by the threshold, reused while the input shape stays the same
+        self._pool = None # threads for the numpy threshold, numpy releases the GIL inside its loops
 
     def getParameterNode(self):
         return EasySegmentationParameterNode(super().getParameterNode())
 
+    def cleanup(self) -> None:
+        """Stops the threshold threads. Whoever calls process owns the logic and calls this when done with it,
+        the widget does not use the logic. The threads are started again if process is called after this.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
     def process(self,
                 inputVolume: vtkMRMLScalarVolumeNode,
                 outputVolume: vtkMRMLScalarVolumeNode,
@@ -919,20 +1476,63 @@ class EasySegmentationLogic(ScriptedLoadableModuleLogic):
         startTime = time.time()
         logging.info("Processing started")
 
-        # Compute the thresholded output volume using the "Threshold Scalar Volume" CLI module
-        cliParams = {
-            "InputVolume": inputVolume.GetID(),
-            "OutputVolume": outputVolume.GetID(),
-            "ThresholdValue": imageThreshold,
-            "ThresholdType": "Above" if invert else "Below",
-        }
-        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True, update_display=showResult)
-        # We don't need the CLI module node anymore, remove it to not clutter the scene with it
-        slicer.mrmlScene.RemoveNode(cliNode)
+        # Compute the thresholded output volume in process, same result as the "Threshold Scalar Volume" CLI
+        # without its subprocess and temporary files: values above (invert) or below the threshold become 0
+        inputArray = slicer.util.arrayFromVolume(inputVolume)
+
+        # the result is written straight into the output volume's own voxels, its image is only
+        # reallocated when it does not match the input
+        inputImage = inputVolume.GetImageData()
+        outputImage = outputVolume.GetImageData()
+        if (outputImage is None or outputImage.GetDimensions() != inputImage.GetDimensions()
+                or outputImage.GetScalarType() != inputImage.GetScalarType()
+                or outputImage.GetNumberOfScalarComponents() != inputImage.GetNumberOfScalarComponents()):
+            outputImage = vtk.vtkImageData()
+            outputImage.SetDimensions(inputImage.GetDimensions())
+            outputImage.AllocateScalars(inputImage.GetScalarType(), inputImage.GetNumberOfScalarComponents())
+            outputVolume.SetAndObserveImageData(outputImage)
+
+        outputVolume.CopyOrientation(inputVolume)
+        outputArray = slicer.util.arrayFromVolume(outputVolume)
+
+        if _load_numba() is not None:
+            _load_numba().thresholdKeep(inputArray.ravel(), float(imageThreshold), invert, outputArray.ravel())
+        else:
+            if self._mask is None or self._mask.shape != inputArray.shape:
+                self._mask = np.empty(inputArray.shape, dtype=bool)
+
+            keep = np.less_equal if invert else np.greater_equal
+            slabCount = min(os.cpu_count() or 1, inputArray.shape[0])
+
+            # small volumes are not worth the thread hand-off
+            if inputArray.size < 1 << 21 or slabCount < 2:
+                self._thresholdSlab(inputArray, outputArray, self._mask, keep, imageThreshold)
+            else:
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+                # split along Z, each thread works on its own contiguous slab of the three arrays
+                bounds = np.linspace(0, inputArray.shape[0], slabCount + 1).astype(int)
+                slabs = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+                list(self._pool.map(lambda slab: self._thresholdSlab(inputArray[slab], outputArray[slab], self._mask[slab], keep, imageThreshold), slabs))
+
+        slicer.util.arrayFromVolumeModified(outputVolume)
+
+        if showResult:
+            outputVolume.CreateDefaultDisplayNodes()
+            slicer.util.setSliceViewerLayers(background=outputVolume)
 
         stopTime = time.time()
         logging.info(f"Processing completed in {stopTime-startTime:.2f} seconds")
 
+    @staticmethod
+    def _thresholdSlab(inputSlab, outputSlab, maskSlab, keep, imageThreshold):
+        keep(inputSlab, imageThreshold, out=maskSlab)
+        # where= leaves the kept voxels alone, so this also works when the output is the input volume
+        np.copyto(outputSlab, inputSlab, where=maskSlab)
+        np.logical_not(maskSlab, out=maskSlab)
+        np.copyto(outputSlab, 0, where=maskSlab)
+
 
 #
 # EasySegmentationTest
@@ -954,6 +1554,7 @@ class EasySegmentationTest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here."""
         self.setUp()
         self.test_EasySegmentation1()
+        self.test_EasySegmentationPairing()
 
     def test_EasySegmentation1(self):
         """Ideally you should have several levels of tests.  At the lowest level
@@ -1000,4 +1601,28 @@ class EasySegmentationTest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[0], inputScalarRange[0])
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
+        logic.cleanup()
+
+        self.delayDisplay("Test passed")
+
+    def test_EasySegmentationPairing(self):
+        """Images are paired with the closest segmentation name, whatever order the files are listed in."""
+
+        self.delayDisplay("Starting the pairing test")
+
+        segFiles = ["/seg/case10_seg.nii.gz", "/seg/case1_seg.nii.gz", "/seg/case2.nrrd", "/seg/ct_case3_label.nii", "/seg/case4.nii.gz", "/seg/case4_seg.nii.gz"]
+        for files in (segFiles, list(reversed(segFiles))):
+            segIndex = SegmentationNameIndex(files, EasySegmentationWidget.find_basename_wo_extension)
+
+            # 'case1' must not pick 'case10_seg' even when it is listed or sorted first
+            self.assertEqual(segIndex.find_seg_file("case1"), "/seg/case1_seg.nii.gz")
+            self.assertEqual(segIndex.find_seg_file("case10"), "/seg/case10_seg.nii.gz")
+            # the same name wins over a longer one
+            self.assertEqual(segIndex.find_seg_file("case4"), "/seg/case4.nii.gz")
+            # image name starting with a segmentation name
+            self.assertEqual(segIndex.find_seg_file("case2_ct"), "/seg/case2.nrrd")
+            # any other containment
+            self.assertEqual(segIndex.find_seg_file("case3"), "/seg/ct_case3_label.nii")
+            self.assertIsNone(segIndex.find_seg_file("case5"))
+
         self.delayDisplay("Test passed")